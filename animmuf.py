@@ -1,27 +1,44 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
 import logging
 import os
 import pathlib
 import shutil
 import sys
-import urllib.request
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import lru_cache
 from subprocess import PIPE, Popen
-from typing import Optional, Tuple, Type
+from typing import Iterator, Optional, Tuple
 
+import urllib3
 import yaml
 from PIL import Image, ImageDraw, ImageFont
 
 CONFIG_NAME = 'animmuf.yaml'
+CACHE_DIR = '.cache'
+MUF_PREFIX = 'CTIPe-MUF_'
+ETAG_SUFFIX = '.etag'
+MODIFIED_SUFFIX = '.modified'
 NOAA = "https://services.swpc.noaa.gov/experimental"
 SOURCE_JSON = NOAA + "/products/animations/ctipe_muf.json"
 RESAMPLING = Image.Resampling.LANCZOS
 DEFAULT_FONT = "/System/Library/Fonts/Supplemental/Arial Narrow.ttf"
 IMG_SIZE = (800, 440)  # suitables image size (1290, 700) (640, 400) (800, 600)
 MARGIN_COLOR = (0xcf, 0xcf, 0xcf)
+MARGIN_HEIGHT = 40
+TEXT = "MUF 36 hours animation\nhttps://bsdworld.org/"
+TEXT_POSITION = (25, 550)
+TEXT_COLOR = (0x80, 0x80, 0x80, 0xff)
+CHUNK_SIZE = 1 << 16
+DOWNLOAD_WORKERS = 8  # Be polite with NOAA's servers
+LUMA_RANGE = [16 + round(v * 219 / 255) for v in range(256)]
+CHROMA_RANGE = [16 + round(v * 224 / 255) for v in range(256)]
+PATH_FIELDS = frozenset(('target_dir', 'muf_file', 'video_file', 'font'))
 
 logging.basicConfig(
   format='%(asctime)s %(name)s:%(lineno)d %(levelname)s - %(message)s',
@@ -29,6 +46,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger('animmuf')
 
+# Keep-alive connections to NOAA, shared by the download threads.
+HTTP = urllib3.PoolManager(maxsize=DOWNLOAD_WORKERS, headers={'Accept-Encoding': 'gzip'})
+
 
 @dataclass(slots=True)
 class Config:
@@ -39,29 +59,10 @@ class Config:
   font_size: int = field(default=16)
   image_size: Tuple[int, int] = field(default=IMG_SIZE)
 
-  def __post_init__(self):
-    # pylint: disable=no-member
-    for name, _field in self.__dataclass_fields__.items():
-      value = getattr(self, name)
-      if isinstance(value, str):
-        setattr(self, name, pathlib.Path(value))
-
-
-class Workdir:
-  def __init__(self, source: pathlib.Path) -> None:
-    self.workdir = source.joinpath('_workdir')
-
-  def __enter__(self) -> pathlib.Path:
-    try:
-      self.workdir.mkdir()
-      return self.workdir
-    except IOError as err:
-      raise err
-
-  def __exit__(self, exc_type: Optional[Type[BaseException]],
-               exc_value: Optional[BaseException],
-               traceback: Optional[Type[BaseException]]) -> None:
-    shutil.rmtree(self.workdir)
+  @classmethod
+  def from_yaml(cls, data: dict) -> 'Config':
+    return cls(**{k: pathlib.Path(v) if k in PATH_FIELDS and isinstance(v, str) else v
+                  for k, v in data.items()})
 
 
 def read_config() -> Config:
@@ -83,151 +84,313 @@ def read_config() -> Config:
   logger.debug('Reading config file "%s"', filename)
   with filename.open('r', encoding='utf-8') as confd:
     config = yaml.safe_load(confd)
-  return Config(**config)
+  return Config.from_yaml(config)
 
 
 def download_with_etag(url: str, filename: pathlib.Path) -> bool:
-  etag_file = filename.with_suffix('.etag')
-  etag = None
-  if etag_file.exists():
-    with open(etag_file, "r", encoding='utf-8') as fde:
-      etag = fde.read().strip()
-
-  request = urllib.request.Request(url)
-  if etag:
-    request.add_header("If-None-Match", etag)
-
+  # Validators returned by the server, stored next to the file.
+  validators = (
+    ('ETag', 'If-None-Match', filename.with_suffix(ETAG_SUFFIX)),
+    ('Last-Modified', 'If-Modified-Since', filename.with_suffix(MODIFIED_SUFFIX)),
+  )
+  headers = {}
+  # The validators only make sense if we still have the file.
+  if filename.exists():
+    for _, request_header, sidecar in validators:
+      if sidecar.exists():
+        headers[request_header] = sidecar.read_text(encoding='utf-8').strip()
+
+  response = HTTP.request('GET', url, headers=headers, preload_content=False)
   try:
-    with urllib.request.urlopen(request) as response:
-      if response.status == 304:
-        return False
-      with open(filename, "wb") as fd:
-        fd.write(response.read())
-      if "ETag" in response.headers:
-        with open(etag_file, "w", encoding='utf-8') as fd:
-          fd.write(response.headers["ETag"])
-        return True
-  except urllib.error.HTTPError as e:
-    if e.code == 304:
+    if response.status == 304:
       return False
-    raise
-  return False
+    if response.status != 200:
+      raise IOError(f'{url}: HTTP error {response.status}')
+    # Keep the current copy until the new one is complete. The leading dot keeps
+    # the temporary file out of list_muf().
+    tmp_path = filename.with_name(f'.{filename.name}.{os.getpid()}.tmp')
+    try:
+      with open(tmp_path, "wb", buffering=0) as fd:
+        shutil.copyfileobj(response, fd, length=CHUNK_SIZE)
+      os.replace(tmp_path, filename)
+    except (IOError, urllib3.exceptions.HTTPError):
+      tmp_path.unlink(missing_ok=True)
+      raise
+    for response_header, _, sidecar in validators:
+      if response_header in response.headers:
+        sidecar.write_text(response.headers[response_header], encoding='utf-8')
+      else:
+        sidecar.unlink(missing_ok=True)
+    return True
+  finally:
+    response.drain_conn()
+    response.release_conn()
+
+
+def read_manifest(src_json: pathlib.Path) -> list[dict]:
+  return json.loads(src_json.read_bytes())
 
 
-def retrieve_files(src_json: pathlib.Path, target_dir: pathlib.Path) -> bool:
+def retrieve_files(src_json: pathlib.Path, target_dir: pathlib.Path) -> Optional[list[dict]]:
+  """Download the new images, return the manifest or None if it didn't change"""
   if not download_with_etag(SOURCE_JSON, src_json):
-    logging.info('No new version of %s', src_json.name)
-    return False
+    logger.info('No new version of %s', src_json.name)
+    return None
 
-  logging.info('New %s file has been downloaded: processing', src_json)
-  with src_json.open('r', encoding='utf-8') as fdin:
-    data_source = json.load(fdin)
-    for url in data_source:
-      retrieve_image(pathlib.Path(url['url']), target_dir)
-  return True
+  logger.info('New %s file has been downloaded: processing', src_json)
+  data_source = read_manifest(src_json)
+
+  with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+    list(executor.map(lambda url: retrieve_image(pathlib.Path(url['url']), target_dir),
+                      data_source))
+  return data_source
 
 
 def retrieve_image(source_path: pathlib.Path, target_dir: pathlib.Path) -> None:
   target_name = target_dir.joinpath(source_path.name)
-  if target_name.exists():
-    return
-  urllib.request.urlretrieve(NOAA + str(source_path), target_name)
-  logger.info('%s saved', target_name)
+  try:
+    if download_with_etag(NOAA + str(source_path), target_name):
+      logger.info('%s saved', target_name)
+  except (IOError, urllib3.exceptions.HTTPError) as err:
+    logger.error('Error downloading %s: %s', source_path.name, err)
+
+
+def list_muf(target_dir: pathlib.Path) -> list[os.DirEntry]:
+  """Return the MUF images found in target_dir, sorted by name"""
+  prefix, prefix_len = MUF_PREFIX, len(MUF_PREFIX)
+  try:
+    with os.scandir(target_dir) as entries:
+      return sorted((e for e in entries
+                     if e.name[:prefix_len] == prefix
+                     and not e.name.endswith((ETAG_SUFFIX, MODIFIED_SUFFIX))),
+                    key=lambda e: e.name)
+  except FileNotFoundError:
+    return []
 
 
-def cleanup(muf_file: pathlib.Path, target_dir: pathlib.Path) -> None:
-  """Cleanup old muf image that are not present in the json manifest"""
+def remove_file(entry: os.DirEntry) -> bool:
+  try:
+    os.unlink(entry.path)
+    logger.info('Delete file: %s', entry.path)
+  except IOError as exp:
+    logger.error(exp)
+    return False
+  return True
+
+
+def cleanup(manifest: list[dict], muf_files: list[os.DirEntry],
+            target_dir: pathlib.Path, key: str) -> list[os.DirEntry]:
+  """Cleanup old muf image that are not present in the json manifest.
+  Return the images still active."""
   logger.info('Cleaning up non active MUF images')
-  current_files = set([])
-  with muf_file.open('r', encoding='utf-8') as fdm:
-    data = json.load(fdm)
-    for entry in data:
-      current_files.add(pathlib.Path(entry['url']).name)
-
-  for filename in target_dir.glob('CTIPe-MUF_*'):
-    if filename.name not in current_files:
-      try:
-        filename.unlink()
-        logger.info('Delete file: %s', filename)
-      except IOError as exp:
-        logger.error(exp)
-
-
-def add_margin(image: Image.Image, top: int, right: int, bottom: int, left: int) -> Image.Image:
-  color = MARGIN_COLOR
-  width, height = image.size
-  new_width = width + right + left
-  new_height = height + top + bottom
-  new_image = Image.new(image.mode, (new_width, new_height), color)
-  new_image.paste(image, (left, top))
-  return new_image
-
-
-def process_image(config: Config, image_path: pathlib.Path, output_path: pathlib.Path) -> None:
-  font = ImageFont.truetype(config.font, int(config.font_size))
+  current_files = frozenset(pathlib.Path(entry['url']).name for entry in manifest)
+
+  active = []
+  for entry in muf_files:
+    if entry.name in current_files or not remove_file(entry):
+      active.append(entry)
+    else:
+      for suffix in (ETAG_SUFFIX, MODIFIED_SUFFIX):
+        pathlib.Path(entry.path).with_suffix(suffix).unlink(missing_ok=True)
+
+  # Also removes the frames made with other settings and leftover temporary files.
+  cached_files = frozenset(f'{name}.{key}.jpg' for name in current_files)
+  for entry in list_muf(target_dir.joinpath(CACHE_DIR)):
+    if entry.name not in cached_files:
+      remove_file(entry)
+  return active
+
+
+@lru_cache(maxsize=4)
+def get_font(font: pathlib.Path, size: int) -> ImageFont.FreeTypeFont:
+  return ImageFont.truetype(font, size)
+
+
+@lru_cache(maxsize=4)
+def get_stamp(font: pathlib.Path, size: int, text: str) -> Tuple[Image.Image, Tuple[int, int]]:
+  """Rasterize the text once into a transparent image, return the image and its offset"""
+  font_face = get_font(font, size)
+  left, top, right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox(
+    (0, 0), text, font=font_face)
+  stamp = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+  ImageDraw.Draw(stamp).text((-left, -top), text, font=font_face, fill=TEXT_COLOR)
+  return stamp, (left, top)
+
+
+def frame_size(config: Config) -> Tuple[int, int]:
+  width, height = config.image_size
+  return width, height + MARGIN_HEIGHT
+
+
+@lru_cache(maxsize=1)
+def get_canvas(size: Tuple[int, int]) -> Image.Image:
+  """Frame buffer reused by every call to process_image in the same process"""
+  return Image.new('RGB', size, MARGIN_COLOR)
+
+
+def process_image(config: Config, image_path: pathlib.Path,
+                  output_path: pathlib.Path) -> Optional[Image.Image]:
+  stamp, (left, top) = get_stamp(config.font, int(config.font_size), TEXT)
+  tmp_path = output_path.with_name(f'{output_path.name}.{os.getpid()}.tmp')
   try:
     image = Image.open(image_path)
-    image = image.convert('RGB')
-    image = image.resize(config.image_size, RESAMPLING)
-    draw = ImageDraw.Draw(image)
-    draw.text((25, 550), "MUF 36 hours animation\nhttps://bsdworld.org/", font=font, fill="gray")
-    image = add_margin(image, 0, 0, 40, 0)
-    image.save(output_path, format="jpeg")
+    # Let libjpeg downscale while decoding. Only JPEG files support it, it's a noop otherwise.
+    width, height = config.image_size
+    image.draft('RGB', (width * 2, height * 2))
+    if image.mode != 'RGB':
+      image = image.convert('RGB')
+    # Single canvas holding the image and its bottom margin. The image covers the top of
+    # the canvas, only the margin needs to be cleared from the previous frame.
+    canvas = get_canvas(frame_size(config))
+    canvas.paste(image.resize(config.image_size, RESAMPLING), (0, 0))
+    canvas.paste(MARGIN_COLOR, (0, height, width, height + MARGIN_HEIGHT))
+    canvas.paste(stamp, (TEXT_POSITION[0] + left, TEXT_POSITION[1] + top), stamp)
+    # Intermediate frame for the H.264 encoder: 4:2:0 chroma, no slow optimize pass.
+    # Written under a temporary name, a partial file would look like a valid cache entry.
+    canvas.save(tmp_path, format="jpeg", quality=82, subsampling=2, optimize=False,
+                progressive=False)
+    os.replace(tmp_path, output_path)
     logger.debug('Save: %s', output_path)
   except Exception as err:
     logger.warning('Error processing %s: %s', image_path, err)
+    tmp_path.unlink(missing_ok=True)
+    return None
+  return canvas
 
 
-def select_files(config: Config,  workdir: pathlib.Path) -> int:
-  file_list = sorted(config.target_dir.glob('CTIPe-MUF_*'))
-  if not file_list:
-    return 0
-  logger.info('Processing: %d images', len(file_list))
-  for count, image_path in enumerate(file_list):
-    output_path = workdir.joinpath(f'CTIPe-MUF-{count:04d}.jpg')
-    process_image(config, image_path, output_path)
-  return len(file_list)
+def is_cached(image_path: pathlib.Path, cached: pathlib.Path) -> bool:
+  try:
+    return cached.stat().st_mtime >= image_path.stat().st_mtime
+  except FileNotFoundError:
+    return False
 
 
-def gen_video(video_file: pathlib.Path, workdir: pathlib.Path) -> None:
+def cache_key(config: Config) -> str:
+  """Short hash of the settings drawn on the frames, changing them invalidates the cache"""
+  settings = repr((str(config.font), int(config.font_size), TEXT))
+  return hashlib.sha1(settings.encode('utf-8')).hexdigest()[:8]
+
+
+def cache_path(config: Config, image_path: pathlib.Path) -> pathlib.Path:
+  return config.target_dir.joinpath(CACHE_DIR, f'{image_path.name}.{cache_key(config)}.jpg')
+
+
+def to_yuv420(image: Image.Image) -> bytes:
+  """Limited range planar YCbCr with 2x2 chroma subsampling (ffmpeg yuv420p)"""
+  if image.mode != 'YCbCr':
+    image = image.convert('YCbCr')
+  luma, blue, red = image.split()
+  # Pillow's YCbCr is full range (JPEG), video players expect the limited "tv" range.
+  return b''.join((luma.point(LUMA_RANGE).tobytes(),
+                   blue.reduce(2).point(CHROMA_RANGE).tobytes(),
+                   red.reduce(2).point(CHROMA_RANGE).tobytes()))
+
+
+def get_frame(config: Config, image_path: pathlib.Path) -> bytes:
+  """Return the raw YUV 4:2:0 pixels of a frame, from the cache when possible"""
+  cached = cache_path(config, image_path)
+  image = None
+  if is_cached(image_path, cached):
+    try:
+      image = Image.open(cached)
+      if image.size != frame_size(config):
+        image = None
+      else:
+        # JPEG is already YCbCr, skip libjpeg's conversion to RGB.
+        image.draft('YCbCr', image.size)
+        image.load()
+    except OSError as err:
+      # A corrupt entry is newer than its source, it would never be replaced.
+      logger.warning('Invalid cache file %s: %s', cached, err)
+      cached.unlink(missing_ok=True)
+      image = None
+  if image is None:
+    image = process_image(config, image_path, cached)
+  if image is None:
+    return b''
+  return to_yuv420(image)
+
+
+def init_worker(config: Config) -> None:
+  """Load the font and render the caption once, when the worker process starts"""
+  get_stamp(config.font, int(config.font_size), TEXT)
+
+
+def iter_frames(config: Config, file_list: list[pathlib.Path]) -> Iterator[bytes]:
+  """Yield the frames in order. They are processed in parallel, but only a few
+  of them are kept in memory while waiting for ffmpeg."""
+  workers = os.cpu_count() or 1
+  with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                           initargs=(config,)) as executor:
+    pending: deque[Future] = deque()
+    for image_path in file_list:
+      pending.append(executor.submit(get_frame, config, image_path))
+      if len(pending) > 2 * workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def ffmpeg_command(ffmpeg: str, size: Tuple[int, int], video_file: pathlib.Path) -> list[str]:
+  width, height = size
+  # Limited range YUV, as produced by to_yuv420(), the same as the output: no conversion.
+  in_args: list[str] = '-y -f rawvideo -pix_fmt yuv420p -color_range tv'.split()
+  in_args.extend(['-s', f'{width}x{height}', '-framerate', '10', '-i', '-'])
+  ou_args: list[str] = '-preset veryfast -tune stillimage -g 10 -crf 23 -c:v libx264'.split()
+  ou_args.extend('-pix_fmt yuv420p -threads 0 -movflags +faststart'.split())
+  return [ffmpeg, *in_args, *ou_args, str(video_file)]
+
+
+def pipe_to_ffmpeg(config: Config, muf_files: list[os.DirEntry]) -> None:
+  """Process the MUF images and pipe them to ffmpeg as raw video frames"""
   ffmpeg = shutil.which('ffmpeg')
   if not ffmpeg:
     raise FileNotFoundError('ffmpeg not found')
 
-  logfile = pathlib.Path('/tmp/animmuf-ffmpeg.log')
-  tmp_file = workdir.joinpath(f'video-{os.getpid()}.mp4')
-  muf_files = workdir.joinpath('CTIPe-MUF-*.jpg')
+  file_list = [pathlib.Path(entry.path) for entry in muf_files]
+  config.target_dir.joinpath(CACHE_DIR).mkdir(exist_ok=True)
+  cached = sum(is_cached(image_path, cache_path(config, image_path)) for image_path in file_list)
+  logger.info('Processing: %d images (%d cached)', len(file_list), cached)
 
-  in_args: list[str] = f'-y -framerate 10 -pattern_type glob -i {muf_files}'.split()
-  ou_args: list[str] = '-crf 23 -c:v libx264 -pix_fmt yuv420p'.split()
-  cmd = [ffmpeg, *in_args, *ou_args, str(tmp_file)]
+  logfile = pathlib.Path('/tmp/animmuf-ffmpeg.log')
+  # Same directory as the video file, the rename is atomic.
+  tmp_file = config.video_file.with_name(f'video-{os.getpid()}.mp4')
+  cmd = ffmpeg_command(ffmpeg, frame_size(config), tmp_file)
   txt_cmd = ' '.join(cmd)
 
   logger.info('Writing ffmpeg output in %s', logfile)
   logger.info("Saving %s video file", tmp_file)
-  with logfile.open("a", encoding='ascii') as err:
-    err.write(txt_cmd)
-    err.write('\n\n')
-    err.flush()
-    with Popen(cmd, shell=False, stdout=PIPE, stderr=err) as proc:
-      proc.wait()
-    if proc.returncode != 0:
-      logger.error('Error generating the video file')
-      return
-    logger.info('mv %s %s', tmp_file, video_file)
-    tmp_file.rename(video_file)
-
-
-def mk_thumbnail(target_dir: pathlib.Path) -> None:
-  muf_files = []
+  try:
+    with logfile.open("a", encoding='ascii') as err:
+      err.write(txt_cmd)
+      err.write('\n\n')
+      err.flush()
+      with Popen(cmd, shell=False, bufsize=0, stdin=PIPE, stdout=PIPE, stderr=err) as proc:
+        try:
+          for frame in iter_frames(config, file_list):
+            proc.stdin.write(frame)
+        except BrokenPipeError:
+          logger.error('ffmpeg closed its input')
+        proc.stdin.close()
+        proc.wait()
+      if proc.returncode != 0:
+        logger.error('Error generating the video file')
+        return
+      logger.info('mv %s %s', tmp_file, config.video_file)
+      tmp_file.rename(config.video_file)
+  finally:
+    # The temporary file sits next to the published video, never leave it behind.
+    tmp_file.unlink(missing_ok=True)
+
+
+def mk_thumbnail(muf_files: list[os.DirEntry]) -> None:
   width, hight = (IMG_SIZE[0], int(IMG_SIZE[0] / (16 / 9)))
-  for filename in target_dir.glob('CTIPe-MUF_*'):
-    muf_files.append((filename.stat().st_ctime, filename))
-  muf_files.sort()
-  tn_source = muf_files.pop()[1]
+  newest = max(muf_files, key=lambda e: e.stat(follow_symlinks=False).st_ctime)
+  tn_source = pathlib.Path(newest.path)
   latest = tn_source.with_name('latest.png')
 
   image = Image.open(tn_source)
+  image.draft('RGB', (width * 2, hight * 2))
   image = image.convert('RGB')
   image = image.resize((width, hight))
 
@@ -250,21 +413,24 @@ def main() -> int:
     logger.error("The target directory %s does not exist", config.target_dir)
     return os.EX_IOERR
 
-  if not retrieve_files(config.muf_file, config.target_dir) and not opts.force:
-    logger.warning('No new images to process')
-    return os.EX_OK
+  manifest = retrieve_files(config.muf_file, config.target_dir)
+  if manifest is None:
+    if not opts.force:
+      logger.warning('No new images to process')
+      return os.EX_OK
+    manifest = read_manifest(config.muf_file)
 
-  mk_thumbnail(config.target_dir)
+  muf_files = list_muf(config.target_dir)
+  mk_thumbnail(muf_files)
 
-  cleanup(config.muf_file, config.target_dir)
+  muf_files = cleanup(manifest, muf_files, config.target_dir, cache_key(config))
   try:
-    with Workdir(config.target_dir) as workdir:
-      if select_files(config, workdir) > 1:
-        gen_video(config.video_file, workdir)
-      else:
-        logging.warning('No MUF files selected')
+    if len(muf_files) > 1:
+      pipe_to_ffmpeg(config, muf_files)
+    else:
+      logger.warning('No MUF files selected')
   except IOError as err:
-    logging.error(err)
+    logger.error(err)
     raise SystemExit(err) from None
   return os.EX_OK
 
@@ -32,7 +32,7 @@ setup(
   author_email='w6bsd@bsdworld.org',
   py_modules=['animmuf'],
   python_requires=">=3.8.0",
-  install_requires=['matplotlib'],
+  install_requires=['matplotlib', 'urllib3'],
   entry_points={
     'console_scripts': [
       'animmuf = animmuf:main'